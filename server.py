@@ -1,14 +1,20 @@
 # server.py — ХАТА© API / Одеса
-import os, json, time, random, threading, sys, re, shutil, base64, logging
+import os, json, time, random, threading, sys, re, shutil, base64, logging, csv, hashlib, http.client, socket, ipaddress
+from collections import OrderedDict, Counter
+from functools import wraps
 from datetime import datetime, timedelta, timezone
-from flask import Flask, request, send_from_directory, jsonify, Response
+from urllib.parse import urlsplit, urljoin
+from flask import Flask, request, send_from_directory, send_file, jsonify, Response
 from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+from flask_socketio import SocketIO, emit, join_room, leave_room
 from werkzeug.utils import secure_filename
 
 # -------------------- Базовые настройки --------------------
 PORT = 8000
 DATA_FILE = 'data.json'
+# Публичный адрес API (например, https://api.example.com). Нужен для абсолютных ссылок
+# вне HTTP-запроса (Socket.IO-рассылки из админки); если пусто — берём хост запроса.
+PUBLIC_BASE_URL = ''
 
 BASE_DIR   = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
@@ -17,8 +23,9 @@ BANNER_DIR = os.path.join(STATIC_DIR, 'banners')
 HOT_DIR    = os.path.join(STATIC_DIR, 'hot')
 ORDERS_DIR = os.path.join(STATIC_DIR, 'orders')
 OG_DIR     = os.path.join(STATIC_DIR, 'og')
+CACHE_DIR  = os.path.join(BASE_DIR, 'cache')
 
-for d in (STATIC_DIR, UPLOAD_DIR, BANNER_DIR, HOT_DIR, ORDERS_DIR, OG_DIR):
+for d in (STATIC_DIR, UPLOAD_DIR, BANNER_DIR, HOT_DIR, ORDERS_DIR, OG_DIR, CACHE_DIR):
     os.makedirs(d, exist_ok=True)
 
 # OG-заглушка (чтобы ссылка og:image всегда была валидной)
@@ -119,6 +126,8 @@ def load_state():
 S = load_state()
 
 def base_url():
+    if PUBLIC_BASE_URL:
+        return PUBLIC_BASE_URL.rstrip('/')
     try:
         return request.host_url.rstrip('/')
     except Exception:
@@ -150,6 +159,12 @@ def refresh_banner(push=True):
     if push:
         socketio.emit('banner', banner_payload())
 
+def to_price(val):
+    try:
+        return int(float(re.sub(r'[^0-9.,]', '', str(val or 0)).replace(',', '.')))
+    except Exception:
+        return 0
+
 def find_ad(aid_or_code):
     for a in S["hot"]:
         if a["id"] == aid_or_code or str(a.get("code")) == str(aid_or_code):
@@ -161,12 +176,36 @@ def find_ad(aid_or_code):
 
 def purge_expired():
     now = now_ms()
-    S["hot"]    = [a for a in S["hot"]    if a.get("activeTill", now + 1) > now]
-    S["normal"] = [a for a in S["normal"] if a.get("activeTill", now + 1) > now]
-    save_state(S)
-
-def broadcast():
-    socketio.emit('listings', {"hot": S["hot"], "normal": S["normal"]})
+    expired = [a for a in S["hot"] + S["normal"] if a.get("activeTill", now + 1) <= now]
+    if expired:
+        S["hot"]    = [a for a in S["hot"]    if a.get("activeTill", now + 1) > now]
+        S["normal"] = [a for a in S["normal"] if a.get("activeTill", now + 1) > now]
+        catalog_removed(expired)
+        save_state(S)
+        broadcast(removed=expired)
+
+def counters(a):
+    return {"id": a["id"], "views": a.get("views", 0), "likes": a.get("likes", 0)}
+
+def broadcast(added=None, removed=None, changed=None):
+    """Без аргументов — полный снимок всем; с added/removed/changed — дельты по комнатам фильтров."""
+    socketio.emit('listings', public_listings(S["hot"], S["normal"]), to=ALL_ROOM)
+    rooms = subscribed_filters()
+    if not rooms:
+        return
+    if added is None and removed is None and changed is None:
+        for key, F in rooms.items():
+            socketio.emit('listings', filtered_listings(F), to=key)
+        return
+    # Предикат считается один раз на (изменение, комнату), а не на клиента
+    for key, F in rooms.items():
+        delta = {
+            "add": [public_ad(a) for a in (added or ()) if ad_matches(a, F)],
+            "del": [a["id"] for a in (removed or ()) if ad_matches(a, F)],
+            "upd": [counters(a) for a in (changed or ()) if ad_matches(a, F)],
+        }
+        if delta["add"] or delta["del"] or delta["upd"]:
+            socketio.emit('listings_delta', delta, to=key)
 
 def push_visitors():
     socketio.emit('visitors', S["visitors"])
@@ -270,13 +309,513 @@ def match_query(q: str, *fields):
             return True
     return False
 
+# Фильтр каталога: те же поля, что у /api/search и у socket-подписок
+FILTER_KEYS = ('district', 'kind', 'rooms', 'price_band')
+
+def parse_filter(src) -> dict:
+    src = src or {}
+    return {
+        "district": norm(str(src.get('district') or '')),
+        "kind": norm(str(src.get('kind') or '')),
+        "rooms": str(src.get('rooms') or '').strip(),
+        "price_band": str(src.get('price_band') or '').strip(),
+    }
+
+def filter_key(F: dict) -> str:
+    # Пустой фильтр -> '' (клиент получает весь каталог)
+    if not any(F.get(k) for k in FILTER_KEYS):
+        return ''
+    return 'flt:' + '|'.join(F.get(k, '') for k in FILTER_KEYS)
+
+def price_ok(price, band: str) -> bool:
+    if not band:
+        return True
+    try:
+        price = int(price or 0)
+    except Exception:
+        price = 0
+    if band.endswith('+'):
+        try:
+            return price > int(band[:-1])
+        except Exception:
+            return True
+    else:
+        try:
+            return price <= int(band)
+        except Exception:
+            return True
+
+def ad_matches(a, F: dict, q: str = '') -> bool:
+    if q and not match_query(q, a.get("title", ""), a.get("desc", ""), a.get("code", ""), a.get("phone", "")):
+        return False
+    if F["district"] and F["district"] != norm(a.get("district", "")):
+        return False
+    if F["kind"] and F["kind"] != norm(a.get("kind", "")):
+        return False
+    if F["rooms"]:
+        try:
+            if int(a.get("rooms", 0)) != int(F["rooms"]):
+                return False
+        except Exception:
+            return False
+    return price_ok(a.get("price", 0), F["price_band"])
+
+# -------------------- Прокси/кэш внешних картинок --------------------
+# cache/<sha1(url)>.bin — тело, .ct — content-type, .val — ETag/Last-Modified и время проверки
+IMG_PROXY = True
+IMG_CACHE_MAX_MB = 512
+IMG_MAX_BYTES = 15 * 1024 * 1024
+IMG_TIMEOUT = 10
+IMG_REVALIDATE_S = 24 * 3600
+IMG_POOL_PER_HOST = 4
+IMG_ALLOW_PRIVATE = False   # True только для локальной отладки: иначе прокси не ходит во внутреннюю сеть
+
+IMG_URLS = {}       # sha1 -> url; проксируем только картинки из объявлений
+IMG_HASH = {}       # url -> sha1
+IMG_INFLIGHT = {}   # sha1 -> Event, чтобы параллельные промахи качали один раз
+IMG_POOL = {}       # (scheme, host, port) -> [свободные соединения]
+IMG_LOCK = threading.Lock()
+IMG_CACHE_BYTES = None
+
+def img_hash(url):
+    h = IMG_HASH.get(url)
+    if h is None:
+        h = IMG_HASH[url] = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return h
+
+def _external_images(ads):
+    for a in ads:
+        for u in a.get("images") or []:
+            if u.startswith(('http://', 'https://')):
+                yield u
+
+def img_index_add(ads):
+    with IMG_LOCK:
+        for u in _external_images(ads):
+            IMG_URLS[img_hash(u)] = u
+
+def img_index_rebuild():
+    global IMG_URLS, IMG_HASH
+    with IMG_LOCK:
+        urls = set(_external_images(S["hot"] + S["normal"]))
+        IMG_HASH = {u: IMG_HASH.get(u) or hashlib.sha1(u.encode('utf-8')).hexdigest() for u in urls}
+        IMG_URLS = {h: u for u, h in IMG_HASH.items()}
+
+def proxied_url(u):
+    if not IMG_PROXY or not u.startswith(('http://', 'https://')):
+        return u
+    # Абсолютная ссылка: фронтенд ходит к API кросс-доменно, как и для баннеров
+    return abs_url(f"/img/{img_hash(u)}")
+
+def public_ad(a):
+    imgs = a.get("images") or []
+    return dict(a, images=[proxied_url(u) for u in imgs]) if imgs else a
+
+def public_listings(hot, normal):
+    return {"hot": [public_ad(a) for a in hot], "normal": [public_ad(a) for a in normal]}
+
+def img_url(h):
+    # Индекс ведётся хуками каталога; промах — просто 404, без пересканирования
+    return IMG_URLS.get(h)
+
+def _pool_conn(key):
+    with IMG_LOCK:
+        idle = IMG_POOL.get(key)
+        if idle:
+            return idle.pop()
+    scheme, host, port = key
+    cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+    return cls(host, port, timeout=IMG_TIMEOUT)
+
+def _pool_put(key, conn):
+    with IMG_LOCK:
+        idle = IMG_POOL.setdefault(key, [])
+        if len(idle) < IMG_POOL_PER_HOST:
+            idle.append(conn)
+            return
+    conn.close()
+
+def _public_host(host):
+    """Все адреса хоста публичные (не loopback/частные/link-local) — защита от SSRF через редиректы."""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except OSError:
+        return False
+    return bool(infos) and all(ipaddress.ip_address(i[4][0].split('%')[0]).is_global for i in infos)
+
+def http_get(url, headers, redirects=3):
+    """GET через пул keep-alive соединений; возвращает (status, headers, body)."""
+    for _ in range(redirects + 1):
+        u = urlsplit(url)
+        if u.scheme not in ('http', 'https') or not u.hostname:
+            raise ValueError(f'bad url {url!r}')
+        # Проверяем каждый переход, включая первый: URL из импорта и редиректы CDN не доверенные
+        if not IMG_ALLOW_PRIVATE and not _public_host(u.hostname):
+            raise ValueError(f'non-public host {u.hostname!r}')
+        key = (u.scheme, u.hostname, u.port)
+        path = (u.path or '/') + (f"?{u.query}" if u.query else '')
+        conn = _pool_conn(key)
+        for attempt in (0, 1):
+            try:
+                conn.request('GET', path, headers=headers)
+                r = conn.getresponse()
+                body = r.read(IMG_MAX_BYTES + 1)
+                break
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if attempt:
+                    raise
+                # Соединение из пула могло протухнуть — одна повторная попытка
+                conn = _pool_conn(key)
+        if len(body) > IMG_MAX_BYTES or r.will_close:
+            conn.close()
+        else:
+            _pool_put(key, conn)
+        if len(body) > IMG_MAX_BYTES:
+            raise ValueError('image too large')
+        if r.status in (301, 302, 303, 307, 308) and r.getheader('Location'):
+            url = urljoin(url, r.getheader('Location'))
+            continue
+        return r.status, r.headers, body
+    raise ValueError('too many redirects')
+
+def _img_path(h, ext):
+    return os.path.join(CACHE_DIR, h + ext)
+
+def _img_meta(h):
+    try:
+        with open(_img_path(h, '.val'), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+def _img_write_meta(h, meta):
+    with open(_img_path(h, '.val'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+
+def img_cached(h):
+    return os.path.isfile(_img_path(h, '.bin')) and os.path.isfile(_img_path(h, '.ct'))
+
+def img_fresh(h):
+    return time.time() - _img_meta(h).get("checked", 0) < IMG_REVALIDATE_S
+
+def _img_download(h, url):
+    global IMG_CACHE_BYTES
+    meta = _img_meta(h) if img_cached(h) else {}
+    headers = {'User-Agent': 'Mozilla/5.0 (KOLO image proxy)', 'Accept': 'image/*'}
+    if meta.get("etag"):
+        headers['If-None-Match'] = meta["etag"]
+    if meta.get("last_modified"):
+        headers['If-Modified-Since'] = meta["last_modified"]
+    status, hdrs, body = http_get(url, headers)
+    if status == 304 and meta:
+        meta["checked"] = time.time()
+        _img_write_meta(h, meta)
+        return True
+    if status != 200:
+        return False
+    ct = (hdrs.get('Content-Type') or '').split(';')[0].strip().lower()
+    if not ct.startswith('image/'):
+        return False
+    bin_path = _img_path(h, '.bin')
+    old = os.path.getsize(bin_path) if os.path.isfile(bin_path) else 0
+    with open(bin_path + '.tmp', 'wb') as f:
+        f.write(body)
+    os.replace(bin_path + '.tmp', bin_path)
+    with open(_img_path(h, '.ct'), 'w', encoding='utf-8') as f:
+        f.write(ct)
+    _img_write_meta(h, {"url": url, "etag": hdrs.get('ETag', ''), "last_modified": hdrs.get('Last-Modified', ''),
+                        "checked": time.time()})
+    if IMG_CACHE_BYTES is not None:
+        IMG_CACHE_BYTES += len(body) - old
+    if IMG_CACHE_BYTES is None or IMG_CACHE_BYTES > IMG_CACHE_MAX_MB * 1024 * 1024:
+        # Только что скачанную запись не вытесняем, даже если она одна больше лимита
+        img_cache_evict(keep=h)
+    return True
+
+def img_fetch(h, url):
+    with IMG_LOCK:
+        ev = IMG_INFLIGHT.get(h)
+        leader = ev is None
+        if leader:
+            ev = IMG_INFLIGHT[h] = threading.Event()
+    if not leader:
+        ev.wait(IMG_TIMEOUT * 2)
+        return img_cached(h)
+    try:
+        return _img_download(h, url)
+    except Exception as e:
+        print("[IMG-ERR]", url, e)
+        return False
+    finally:
+        with IMG_LOCK:
+            IMG_INFLIGHT.pop(h, None)
+        ev.set()
+
+def img_cache_evict(keep=None):
+    """LRU по mtime .bin (при каждой выдаче mtime обновляется); чистим до 90% лимита, кроме keep."""
+    global IMG_CACHE_BYTES
+    entries = []
+    for name in os.listdir(CACHE_DIR):
+        if name.endswith('.bin'):
+            try:
+                st = os.stat(os.path.join(CACHE_DIR, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name[:-4]))
+    total = sum(e[1] for e in entries)
+    limit = IMG_CACHE_MAX_MB * 1024 * 1024
+    if total > limit:
+        entries.sort()
+        for _, size, h in entries:
+            if total <= limit * 0.9:
+                break
+            if h == keep:
+                continue
+            for ext in ('.bin', '.ct', '.val'):
+                try:
+                    os.remove(_img_path(h, ext))
+                except OSError:
+                    pass
+            total -= size
+    IMG_CACHE_BYTES = total
+
+@app.route('/img/<h>')
+def img_proxy(h):
+    if not re.fullmatch(r'[0-9a-f]{40}', h):
+        return ("", 404)
+    url = img_url(h)
+    if not img_cached(h) or (url and not img_fresh(h)):
+        if not url:
+            return ("", 404)
+        if not img_fetch(h, url) and not img_cached(h):
+            return ("", 502, {"Cache-Control": "no-store"})
+    bin_path = _img_path(h, '.bin')
+    try:
+        os.utime(bin_path)
+        with open(_img_path(h, '.ct'), 'r', encoding='utf-8') as f:
+            ct = f.read().strip() or 'application/octet-stream'
+    except OSError:
+        return ("", 404)
+    return send_file(bin_path, mimetype=ct, conditional=True, max_age=86400)
+
+# -------------------- Лимиты запросов --------------------
+# route -> (токенов в секунду, ёмкость корзины). Корзины отдельно по X-KOLO-UID и по IP.
+RATE_LIMITS = {
+    'view':    (1.0, 30),
+    'like':    (0.5, 20),
+    'log':     (5.0, 60),
+    'create':  (0.05, 5),
+    'connect': (0.5, 20),
+}
+# Адреса прокси (Cloudflare/nginx), от которых принимаем CF-Connecting-IP/X-Forwarded-For
+TRUSTED_PROXIES = {'127.0.0.1', '::1'}
+RATE_TABLE_MAX = 50000          # корзин в памяти; самые давние вытесняются
+MAX_CONCURRENT_UPLOADS = 4
+MAX_SOCKETS = 5000
+
+BUCKETS = OrderedDict()         # ключ -> [токены, время последнего пополнения]
+BUCKETS_LOCK = threading.Lock()
+UPLOAD_SLOTS = threading.BoundedSemaphore(MAX_CONCURRENT_UPLOADS)
+SOCKETS_ACTIVE = 0
+
+def client_ip():
+    return request.headers.get('CF-Connecting-IP') or request.headers.get('X-Forwarded-For', '').split(',')[0] or request.remote_addr
+
+def limiter_ip():
+    """IP для лимитов: заголовкам прокси верим только если запрос пришёл от доверенного прокси."""
+    peer = request.remote_addr or ''
+    if peer not in TRUSTED_PROXIES:
+        return peer
+    cf = request.headers.get('CF-Connecting-IP', '').strip()
+    if cf:
+        return cf
+    # Берём самый правый адрес, добавленный не нашими прокси: левые части подделываются клиентом
+    for hop in reversed(request.headers.get('X-Forwarded-For', '').split(',')):
+        hop = hop.strip()
+        if hop and hop not in TRUSTED_PROXIES:
+            return hop
+    return peer
+
+def _bucket(key, burst, rate, now):
+    b = BUCKETS.get(key)
+    if b is None:
+        if len(BUCKETS) >= RATE_TABLE_MAX:
+            BUCKETS.popitem(last=False)
+        b = BUCKETS[key] = [burst, now]
+    else:
+        BUCKETS.move_to_end(key)
+        b[0] = min(burst, b[0] + (now - b[1]) * rate)
+        b[1] = now
+    return b
+
+def allow(route, uid=''):
+    rate, burst = RATE_LIMITS[route]
+    now = time.monotonic()
+    keys = [f"ip:{route}:{limiter_ip()}"]
+    if uid:
+        keys.append(f"uid:{route}:{uid}")
+    with BUCKETS_LOCK:
+        # Сначала проверяем все корзины, списываем только если проходят все
+        bs = [_bucket(k, burst, rate, now) for k in keys]
+        if any(b[0] < 1 for b in bs):
+            return False
+        for b in bs:
+            b[0] -= 1
+        return True
+
+def limited(route):
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method != 'OPTIONS' and not allow(route, request.headers.get('X-KOLO-UID', '')):
+                retry = max(1, int(1 / RATE_LIMITS[route][0]))
+                return ("", 429, {"Retry-After": str(retry), "Cache-Control": "no-store"})
+            return fn(*args, **kwargs)
+        return wrapper
+    return deco
+
+def admitted(slots):
+    # Без ожидания: если все слоты заняты — сразу 503, тело запроса не читаем
+    def deco(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if request.method == 'OPTIONS':
+                return fn(*args, **kwargs)
+            if not slots.acquire(blocking=False):
+                return ("", 503, {"Retry-After": "5", "Cache-Control": "no-store"})
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                slots.release()
+        return wrapper
+    return deco
+
+# -------------------- Фасеты --------------------
+# Счётчики по району/типу/кімнатам и гистограмма цен ведутся инкрементально
+# (pub, add, import, delcode, reset, истечение срока); CATALOG_REV растёт при каждом изменении.
+# Ключи нормализуются так же, как в ad_matches, чтобы счётчик совпадал с выдачей /api/search;
+# для показа хранится самая частая исходная подпись каждого ключа.
+PRICE_EDGES = (10000, 15000, 20000, 25000, 30000)   # значения price_band во фронтенде
+FACET_DIMS = ("district", "kind", "rooms", "price")
+FACET_CACHE_MAX = 256
+
+FACETS = {k: Counter() for k in FACET_DIMS}          # измерение -> норм. ключ -> число
+FACET_LABELS = {k: {} for k in FACET_DIMS}           # измерение -> норм. ключ -> Counter(подпись)
+FACETS_TOTAL = 0
+CATALOG_REV = now_ms()          # уникально на каждый запуск, чтобы ETag прошлого процесса не совпал
+FACET_CACHE = OrderedDict()     # ключ фильтра -> (rev, payload)
+FACETS_LOCK = threading.Lock()
+
+def price_bucket(price):
+    """Непересекающийся диапазон цены; в ответе он сворачивается в накопительные price_band."""
+    try:
+        price = int(price or 0)
+    except Exception:
+        price = 0
+    for e in PRICE_EDGES:
+        if price <= e:
+            return str(e)
+    return f"{PRICE_EDGES[-1]}+"
+
+def facet_values(a):
+    """измерение -> (ключ как в ad_matches, подпись для показа)."""
+    district = str(a.get("district") or '').strip()
+    kind = str(a.get("kind") or '').strip()
+    try:
+        rooms = str(int(a.get("rooms", 0))) if str(a.get("rooms") or '').strip() else ''
+    except Exception:
+        rooms = ''
+    price = price_bucket(a.get("price", 0))
+    return {
+        "district": (norm(district), district),
+        "kind": (norm(kind), kind),
+        "rooms": (rooms, rooms),
+        "price": (price, price),
+    }
+
+def _facet_count(C, L, a, sign):
+    for k, (key, label) in facet_values(a).items():
+        if not key:
+            continue
+        C[k][key] += sign
+        labels = L[k].setdefault(key, Counter())
+        labels[label] += sign
+        if C[k][key] <= 0:
+            del C[k][key]
+            del L[k][key]
+        elif labels[label] <= 0:
+            del labels[label]
+
+def _facets_apply(ads, sign):
+    global FACETS_TOTAL, CATALOG_REV
+    with FACETS_LOCK:
+        for a in ads:
+            _facet_count(FACETS, FACET_LABELS, a, sign)
+            FACETS_TOTAL += sign
+        CATALOG_REV += 1
+
+def facets_add(ads):
+    _facets_apply(ads, 1)
+
+def facets_remove(ads):
+    _facets_apply(ads, -1)
+
+def facets_rebuild():
+    global FACETS_TOTAL
+    with FACETS_LOCK:
+        for k in FACET_DIMS:
+            FACETS[k].clear()
+            FACET_LABELS[k].clear()
+        FACETS_TOTAL = 0
+    facets_add(S["hot"] + S["normal"])
+
+def count_facets(ads):
+    C = {k: Counter() for k in FACET_DIMS}
+    L = {k: {} for k in FACET_DIMS}
+    n = 0
+    for a in ads:
+        _facet_count(C, L, a, 1)
+        n += 1
+    return C, L, n
+
+def facets_payload(C, L, total, rev):
+    out = {}
+    for k in ("district", "kind", "rooms"):
+        out[k] = dict(sorted((L[k][key].most_common(1)[0][0], n) for key, n in C[k].items()))
+    # Как price_band в /api/search: "N" — цена <= N (накопительно), "N+" — цена > N
+    price, acc = {}, 0
+    for e in PRICE_EDGES:
+        acc += C["price"].get(str(e), 0)
+        price[str(e)] = acc
+    top = f"{PRICE_EDGES[-1]}+"
+    price[top] = C["price"].get(top, 0)
+    out["price"] = price
+    return {"ok": True, "rev": rev, "total": total, "facets": out}
+
+# -------------------- Хуки каталога --------------------
+# Все изменения списков hot/normal проходят через эти функции: фасеты и индекс картинок.
+def catalog_added(ads):
+    facets_add(ads)
+    img_index_add(ads)
+
+def catalog_removed(ads):
+    facets_remove(ads)
+    img_index_rebuild()
+
+def catalog_rebuild():
+    facets_rebuild()
+    img_index_rebuild()
+
+catalog_rebuild()
+
 # -------------------- API --------------------
 @app.route('/api/list', methods=['GET', 'OPTIONS'])
 def api_list():
     if request.method == 'OPTIONS':
         return ("", 204)
     purge_expired()
-    return jsonify({"ok": True, "data": {"hot": S["hot"], "normal": S["normal"]}, "banner": banner_payload()})
+    return jsonify({"ok": True, "data": public_listings(S["hot"], S["normal"]), "banner": banner_payload()})
 
 @app.route('/api/search', methods=['GET', 'OPTIONS'])
 def api_search():
@@ -284,54 +823,53 @@ def api_search():
         return ("", 204)
     purge_expired()
     q = request.args.get('q', '')
-    district = (request.args.get('district') or '').strip()
-    band = (request.args.get('price_band') or '').strip()
-    kind = (request.args.get('kind') or '').strip()
-    rooms = (request.args.get('rooms') or '').strip()
-
-    def price_ok(price: int) -> bool:
-        if not band:
-            return True
-        try:
-            price = int(price or 0)
-        except Exception:
-            price = 0
-        if band.endswith('+'):
-            try:
-                return price > int(band[:-1])
-            except Exception:
-                return True
-        else:
-            try:
-                return price <= int(band)
-            except Exception:
-                return True
+    F = parse_filter(request.args)
 
     def filt(arr):
-        res = []
-        for a in arr:
-            if not match_query(q, a.get("title", ""), a.get("desc", ""), a.get("code", ""), a.get("phone", "")):
-                continue
-            if district and norm(district) != norm(a.get("district", "")):
-                continue
-            if kind and norm(kind) != norm(a.get("kind", "")):
-                continue
-            if rooms:
-                try:
-                    if int(a.get("rooms", 0)) != int(rooms):
-                        continue
-                except Exception:
-                    continue
-            if not price_ok(a.get("price", 0)):
-                continue
-            res.append(a)
-        return res
+        return [a for a in arr if ad_matches(a, F, q)]
 
     hot = filt(S["hot"])
     normal = filt(S["normal"])
-    return jsonify({"ok": True, "data": {"hot": hot, "normal": normal}})
+    return jsonify({"ok": True, "data": public_listings(hot, normal)})
+
+@app.route('/api/facets', methods=['GET', 'OPTIONS'])
+def api_facets():
+    if request.method == 'OPTIONS':
+        return ("", 204)
+    purge_expired()
+    q = norm(request.args.get('q', ''))
+    F = parse_filter(request.args)
+    key = filter_key(F) + (f"|q:{q}" if q else '')
+    tag = hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+    rev = CATALOG_REV
+    if f"facets-{rev}-{tag}" in request.if_none_match:
+        return ("", 304, {"ETag": f'"facets-{rev}-{tag}"', "Cache-Control": "no-cache"})
+
+    if not key:
+        with FACETS_LOCK:
+            payload = facets_payload(FACETS, FACET_LABELS, FACETS_TOTAL, CATALOG_REV)
+    else:
+        with FACETS_LOCK:
+            hit = FACET_CACHE.get(key)
+            if hit and hit[0] == rev:
+                FACET_CACHE.move_to_end(key)
+        if hit and hit[0] == rev:
+            payload = hit[1]
+        else:
+            C, L, total = count_facets(a for a in S["hot"] + S["normal"] if ad_matches(a, F, q))
+            payload = facets_payload(C, L, total, rev)
+            with FACETS_LOCK:
+                FACET_CACHE[key] = (rev, payload)
+                FACET_CACHE.move_to_end(key)
+                while len(FACET_CACHE) > FACET_CACHE_MAX:
+                    FACET_CACHE.popitem(last=False)
+    resp = jsonify(payload)
+    resp.headers['ETag'] = f'"facets-{payload["rev"]}-{tag}"'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
 
 @app.route('/api/view/<aid>', methods=['POST', 'OPTIONS'])
+@limited('view')
 def api_view(aid):
     if request.method == 'OPTIONS':
         return ("", 204)
@@ -343,10 +881,11 @@ def api_view(aid):
             a["views"] = int(a.get("views", 0)) + 1
             S["views_by"][aid][uid] = now_ms()
             save_state(S)
-            broadcast()
+            broadcast(changed=[a])
     return ("", 204)
 
 @app.route('/api/like/<aid>', methods=['POST', 'OPTIONS'])
+@limited('like')
 def api_like(aid):
     if request.method == 'OPTIONS':
         return ("", 204)
@@ -359,11 +898,13 @@ def api_like(aid):
         L.append(uid)
         a["likes"] = int(a.get("likes", 0)) + 1
         save_state(S)
-        broadcast()
+        broadcast(changed=[a])
     return jsonify({"likes": a["likes"], "liked": uid in L})
 
 # ---- CREATE => pending (+ детальный лог заявки пользователя)
 @app.route('/api/create', methods=['POST', 'OPTIONS'])
+@limited('create')
+@admitted(UPLOAD_SLOTS)
 def api_create():
     if request.method == 'OPTIONS':
         return ("", 204)
@@ -376,12 +917,6 @@ def api_create():
     rooms = (request.form.get('rooms') or "").strip()
     prop_kind = (request.form.get('kind') or "").strip()
 
-    def to_price(val):
-        try:
-            return int(float(re.sub(r'[^0-9.,]', '', str(val or 0)).replace(',', '.')))
-        except Exception:
-            return 0
-
     price = to_price(request.form.get('price'))
 
     order_files = []
@@ -482,23 +1017,52 @@ def api_support():
 
 # ---- Логи подій з клієнта
 @app.route('/api/log', methods=['POST'])
+@limited('log')
 def api_log():
     try:
         j = request.get_json(force=True)
         uid = request.headers.get('X-KOLO-UID', '')
-        ip = request.headers.get('CF-Connecting-IP') or request.headers.get('X-Forwarded-For', '').split(',')[0] or request.remote_addr
+        ip = client_ip()
         print(f"[EVENT] uid={uid} ip={ip} action={j.get('action')} extra={j.get('extra',{})}")
     except Exception as e:
         print("[EVENT-ERR]", e)
     return ("", 204)
 
 # -------------------- Socket.IO (polling) --------------------
+# Подписки по фильтру: клиенты с одинаковым нормализованным фильтром сидят в одной комнате
+ALL_ROOM = 'listings:all'
+SUBS = {}    # sid -> ключ комнаты
+ROOMS = {}   # ключ комнаты -> [фильтр, число подписчиков]
+SUBS_LOCK = threading.Lock()
+
+def _release_room(key):
+    r = ROOMS.get(key)
+    if r:
+        r[1] -= 1
+        if r[1] <= 0:
+            ROOMS.pop(key, None)
+
+def subscribed_filters():
+    with SUBS_LOCK:
+        return {k: r[0] for k, r in ROOMS.items()}
+
+def filtered_listings(F):
+    return public_listings([a for a in S["hot"] if ad_matches(a, F)],
+                           [a for a in S["normal"] if ad_matches(a, F)])
+
 @socketio.on('connect')
 def on_connect(auth):
+    global SOCKETS_ACTIVE
     uid = (auth or {}).get('uid', '') if isinstance(auth, dict) else ''
+    if not allow('connect', uid):
+        return False
+    with BUCKETS_LOCK:
+        if SOCKETS_ACTIVE >= MAX_SOCKETS:
+            return False
+        SOCKETS_ACTIVE += 1
     try:
         ua = request.headers.get('User-Agent', '')
-        ip = request.headers.get('CF-Connecting-IP') or request.headers.get('X-Forwarded-For', '').split(',')[0] or request.remote_addr
+        ip = client_ip()
         if uid and uid not in S["seen_uids"]:
             print(f"[VISIT] uid={uid} ip={ip} ua={ua[:140]}")
             S["seen_uids"][uid] = now_ms()
@@ -507,9 +1071,38 @@ def on_connect(auth):
         print("[VISIT-LOG-ERR]", e)
     S["visitors"] = int(S.get("visitors", 0)) + 1
     save_state(S)
+    join_room(ALL_ROOM)
     emit('visitors', S["visitors"])
     emit('banner', banner_payload())
-    emit('listings', {"hot": S["hot"], "normal": S["normal"]})
+    emit('listings', public_listings(S["hot"], S["normal"]))
+
+@socketio.on('subscribe')
+def on_subscribe(data):
+    # Клиент присылает тот же фильтр, что и в /api/search; пустой — весь каталог
+    F = parse_filter(data if isinstance(data, dict) else {})
+    key = filter_key(F)
+    sid = request.sid
+    with SUBS_LOCK:
+        prev = SUBS.pop(sid, None)
+        if prev:
+            _release_room(prev)
+        if key:
+            SUBS[sid] = key
+            ROOMS.setdefault(key, [F, 0])[1] += 1
+    leave_room(prev or ALL_ROOM)
+    join_room(key or ALL_ROOM)
+    emit('listings', filtered_listings(F) if key else public_listings(S["hot"], S["normal"]))
+    return {"ok": True, "room": key or ALL_ROOM}
+
+@socketio.on('disconnect')
+def on_disconnect(*_):
+    global SOCKETS_ACTIVE
+    with BUCKETS_LOCK:
+        SOCKETS_ACTIVE = max(0, SOCKETS_ACTIVE - 1)
+    with SUBS_LOCK:
+        key = SUBS.pop(request.sid, None)
+        if key:
+            _release_room(key)
 
 def tick_visitors():
     while True:
@@ -520,11 +1113,212 @@ def tick_visitors():
 
 threading.Thread(target=tick_visitors, daemon=True).start()
 
+# -------------------- Импорт/экспорт объявлений --------------------
+EXPORT_FIELDS = ('id', 'code', 'type', 'title', 'price', 'district', 'phone', 'rooms',
+                 'kind', 'desc', 'images', 'likes', 'views', 'activeTill')
+PROGRESS_EVERY = 1000
+IMPORT_MAX_ERRORS_SHOWN = 20
+
+def bulk_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.jsonl', '.ndjson'):
+        return 'jsonl'
+    if ext == '.csv':
+        return 'csv'
+    return 'json'
+
+def iter_json_array(f, chunk=64 * 1024):
+    """Потоково отдаёт элементы JSON-массива, не читая файл целиком.
+    Файл в формате data.json ({"hot": [...], "normal": [...]}) читается обычным json.load.
+    Ошибки разбора не бросаются, а отдаются как ValueError-маркер строки; после них чтение прекращается."""
+    dec = json.JSONDecoder()
+    buf, pos, eof, started = '', 0, False, False
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n,':
+            pos += 1
+        if pos >= len(buf):
+            if eof:
+                yield ValueError('unexpected end of JSON' if started else 'empty file')
+                return
+            more = f.read(chunk)
+            buf, pos, eof = more, 0, not more
+            continue
+        if not started:
+            if buf[pos] == '{':
+                try:
+                    D = json.loads(buf[pos:] + f.read())
+                except ValueError as e:
+                    yield ValueError(f'bad JSON: {e}')
+                    return
+                yield from (D.get('hot') or []) + (D.get('normal') or [])
+                return
+            if buf[pos] != '[':
+                yield ValueError('expected JSON array')
+                return
+            started, pos = True, pos + 1
+            continue
+        if buf[pos] == ']':
+            return
+        try:
+            obj, pos = dec.raw_decode(buf, pos)
+        except ValueError as e:
+            if eof:
+                yield ValueError(f'bad JSON: {e}')
+                return
+            more = f.read(chunk)
+            buf, pos, eof = buf[pos:] + more, 0, not more
+            continue
+        yield obj
+
+def iter_rows(path):
+    """Строки файла; нечитаемая строка отдаётся как ValueError, чтобы import_ads посчитал её в bad."""
+    fmt = bulk_format(path)
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            rows = csv.DictReader(f)
+            while True:
+                try:
+                    yield next(rows)
+                except StopIteration:
+                    return
+                except csv.Error as e:
+                    yield ValueError(f'bad CSV: {e}')
+        elif fmt == 'jsonl':
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError as e:
+                    yield ValueError(f'bad JSON: {e}')
+        else:
+            yield from iter_json_array(f)
+
+def clean_ad(r, now):
+    if not isinstance(r, dict):
+        raise ValueError('not an object')
+    title = str(r.get('title') or '').strip()[:140]
+    if not title:
+        raise ValueError('no title')
+    typ = str(r.get('type') or 'normal').strip().lower()
+    if typ not in ('hot', 'normal'):
+        raise ValueError(f'bad type {typ!r}')
+    imgs = r.get('images') or []
+    if isinstance(imgs, str):
+        imgs = imgs.split()
+    imgs = [str(u).strip() for u in imgs if str(u).strip()]
+    till = r.get('activeTill')
+    if till in (None, ''):
+        till = (datetime.now(timezone.utc) + timedelta(days=30)).timestamp() * 1000
+    till = float(till)
+    if till <= now:
+        raise ValueError('expired')
+    return {
+        "id": str(r.get('id') or '').strip(),
+        "code": str(r.get('code') or '').strip(),
+        "type": typ,
+        "title": title,
+        "price": to_price(r.get('price')),
+        "district": str(r.get('district') or ''),
+        "phone": str(r.get('phone') or '+380'),
+        "rooms": str(r.get('rooms') or ''),
+        "kind": str(r.get('kind') or ''),
+        "desc": str(r.get('desc') or ''),
+        "images": (imgs if imgs else ["https://picsum.photos/seed/new/1200/800"]),
+        "likes": int(to_price(r.get('likes'))),
+        "views": int(to_price(r.get('views'))),
+        "activeTill": till
+    }
+
+def import_ads(path, dry=False):
+    """Валидирует строки файла и применяет их одним изменением: один save_state и один broadcast."""
+    now = now_ms()
+    codes = {str(a.get("code")) for a in S["hot"] + S["normal"]} | {str(p.get("code")) for p in S["pending"]}
+    ids = {a["id"] for a in S["hot"] + S["normal"]}
+    ok, bad, n = [], 0, 0
+    top = S.get("seq", 51369)
+    for n, r in enumerate(iter_rows(path), 1):
+        # Прогресс печатаем до валидации, чтобы битые строки его не пропускали
+        if n > 1 and (n - 1) % PROGRESS_EVERY == 0:
+            print(f"[IMPORT] {n - 1} rows, ok={len(ok)} bad={bad}")
+        try:
+            if isinstance(r, Exception):
+                raise r
+            ad = clean_ad(r, now)
+        except Exception as e:
+            bad += 1
+            if bad <= IMPORT_MAX_ERRORS_SHOWN:
+                print(f"[IMPORT] row {n}: {e}")
+            continue
+        # Код из файла оставляем, если он свободен и не ниже seq (коды ниже seq могли
+        # принадлежать удалённым объявлениям); иначе выделим новый ниже
+        if ad["code"] in codes or (ad["code"].isdigit() and int(ad["code"]) < S.get("seq", 51369)):
+            ad["code"] = ''
+        if ad["code"]:
+            codes.add(ad["code"])
+            if ad["code"].isdigit():
+                top = max(top, int(ad["code"]) + 1)
+        if ad["id"] in ids:
+            ad["id"] = ''
+        if ad["id"]:
+            ids.add(ad["id"])
+        ok.append(ad)
+
+    fresh = [a for a in ok if not a["code"]]
+    hot = [a for a in ok if a["type"] == "hot"]
+    normal = [a for a in ok if a["type"] == "normal"]
+    if dry:
+        print(f"[IMPORT-DRY] rows={n} ok={len(ok)} bad={bad} hot={len(hot)} normal={len(normal)} new_codes={len(fresh)}")
+        return 0
+
+    # Коды выделяем одним блоком
+    S["seq"] = top + len(fresh)
+    stamp = now_ms()
+    for i, a in enumerate(fresh):
+        a["code"] = str(top + i).zfill(5)
+    for a in ok:
+        if not a["id"]:
+            a["id"] = f"ad_{stamp}_{a['code']}"
+    S["hot"] = hot + S["hot"]
+    S["normal"] = normal + S["normal"]
+    catalog_added(ok)
+    save_state(S)
+    if ok:
+        broadcast(added=ok)
+    print(f"[IMPORT] rows={n} added={len(ok)} bad={bad} hot={len(hot)} normal={len(normal)}")
+    return len(ok)
+
+def export_ads(path):
+    """Пишет объявления построчно во временный файл и атомарно подменяет целевой."""
+    fmt = bulk_format(path)
+    ads = S["hot"] + S["normal"]
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            w = csv.DictWriter(f, fieldnames=EXPORT_FIELDS, extrasaction='ignore')
+            w.writeheader()
+        elif fmt == 'json':
+            f.write('[\n')
+        for i, a in enumerate(ads):
+            if fmt == 'csv':
+                w.writerow(dict(a, images=' '.join(a.get("images") or [])))
+            elif fmt == 'jsonl':
+                f.write(json.dumps(a, ensure_ascii=False) + '\n')
+            else:
+                f.write((',\n' if i else '') + json.dumps(a, ensure_ascii=False))
+            if (i + 1) % PROGRESS_EVERY == 0:
+                print(f"[EXPORT] {i + 1}/{len(ads)}")
+        if fmt == 'json':
+            f.write('\n]\n')
+    os.replace(tmp, path)
+    return len(ads)
+
 # -------------------- Admin консоль --------------------
 HELP = """
 Admin:
   help | list | count | reset
-  export <path.json> | import <path.json>
+  export <path.json|.jsonl|.csv> | import <path.json|.jsonl|.csv> [--dry]
   setvis <N> | inc <N>
 
   # pending
@@ -563,10 +1357,26 @@ def admin_console():
                 S["normal"] = []
                 S["likes_by"] = {}
                 S["views_by"] = {}
+                catalog_rebuild()
                 save_state(S)
                 broadcast()
                 print("[RESET] done")
 
+            elif s.startswith("export "):
+                path = s.split(" ", 1)[1].strip()
+                n = export_ads(path)
+                print("[EXPORT]", path, "ads:", n)
+
+            elif s.startswith("import "):
+                path = s.split(" ", 1)[1].strip()
+                dry = path.endswith(" --dry")
+                if dry:
+                    path = path[:-len(" --dry")].strip()
+                if not os.path.isfile(path):
+                    print("no file:", path)
+                    continue
+                import_ads(path, dry=dry)
+
             elif s == "pend":
                 for p in S["pending"]:
                     print(f"[PENDING] {p['kind']} [{p['code']}] {p['data'].get('title','')} files={len(p.get('order_files',[]))}")
@@ -609,8 +1419,9 @@ def admin_console():
                         ad_images = ["https://picsum.photos/seed/new/1200/800"]
                     ad["images"] = ad_images
                     (S["hot"] if ad["type"] == "hot" else S["normal"]).insert(0, ad)
+                    catalog_added([ad])
                     save_state(S)
-                    broadcast()
+                    broadcast(added=[ad])
                     print("[PUBLISHED]", ad["type"], code, "images:", len(ad_images))
 
                 S["pending"] = [x for x in S["pending"] if x["code"] != code]
@@ -698,19 +1509,20 @@ def admin_console():
                     "activeTill": (datetime.now(timezone.utc) + timedelta(days=days)).timestamp() * 1000
                 }
                 (S["hot"] if kind == 'hot' else S["normal"]).insert(0, ad)
+                catalog_added([ad])
                 save_state(S)
-                broadcast()
+                broadcast(added=[ad])
                 print(f"[ADD-{kind.upper()}] {title} [{code}] imgs:{len(imgs)}")
 
             elif s.startswith("delcode "):
                 code = s.split(" ", 1)[1].strip()
-                before = (len(S["hot"]) + len(S["normal"]))
+                gone = [a for a in S["hot"] + S["normal"] if str(a.get("code")) == code]
                 S["hot"]   = [a for a in S["hot"]   if str(a.get("code")) != code]
                 S["normal"] = [a for a in S["normal"] if str(a.get("code")) != code]
+                catalog_removed(gone)
                 save_state(S)
-                broadcast()
-                after = (len(S["hot"]) + len(S["normal"]))
-                print("[DELCODE]", code, "removed:", before - after)
+                broadcast(removed=gone)
+                print("[DELCODE]", code, "removed:", len(gone))
 
             elif s.startswith("addviews "):
                 _, rest = s.split(" ", 1)
@@ -721,7 +1533,7 @@ def admin_console():
                     continue
                 ad["views"] = int(ad.get("views", 0)) + int(n)
                 save_state(S)
-                broadcast()
+                broadcast(changed=[ad])
                 print("[ADDVIEWS]", tgt, "+", n)
 
             elif s.startswith("addlikes "):
@@ -733,7 +1545,7 @@ def admin_console():
                     continue
                 ad["likes"] = int(ad.get("likes", 0)) + int(n)
                 save_state(S)
-                broadcast()
+                broadcast(changed=[ad])
                 print("[ADDLIKES]", tgt, "+", n)
 
             else:
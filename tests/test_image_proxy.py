@@ -0,0 +1,116 @@
+# Проверка /img/-прокси на локальном HTTP-источнике вместо внешнего CDN.
+# server.py при импорте пишет data.json и cache/ рядом с собой, поэтому грузим копию во временной папке.
+import importlib.util, io, os, shutil, sys, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+SERVER_PY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+BODY = b'\xff\xd8' + b'JPEG' * 250
+ETAG = '"v1"'
+
+
+class Origin(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    hits = []
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        Origin.hits.append((self.path, self.headers.get('If-None-Match')))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        time.sleep(0.2)  # окно, в которое попадают параллельные промахи
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+
+@pytest.fixture(scope='module')
+def srv(tmp_path_factory):
+    root = tmp_path_factory.mktemp('srv')
+    shutil.copy(SERVER_PY, root / 'server.py')
+    # Админ-консоль читает stdin в фоне — даём ей пустой поток, чтобы она сразу завершилась
+    mp = pytest.MonkeyPatch()
+    mp.setattr(sys, 'stdin', io.StringIO())
+    spec = importlib.util.spec_from_file_location('kolo_server', root / 'server.py')
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    mod.IMG_ALLOW_PRIVATE = True
+    yield mod
+    mp.undo()
+
+
+@pytest.fixture(scope='module')
+def origin():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Origin)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def reset(srv):
+    Origin.hits.clear()
+    srv.IMG_REVALIDATE_S = 24 * 3600
+    srv.IMG_CACHE_MAX_MB = 512
+    srv.IMG_CACHE_BYTES = None
+
+
+def publish(srv, url):
+    ad = {"id": f"ad_test_{len(srv.S['normal'])}", "code": "00000", "type": "normal", "title": "t",
+          "price": 1, "district": "", "kind": "", "rooms": "", "images": [url], "activeTill": 4e12}
+    srv.S["normal"].insert(0, ad)
+    srv.catalog_added([ad])
+    return srv.img_hash(url)
+
+
+def test_concurrent_misses_hit_origin_once(srv, origin):
+    h = publish(srv, f"{origin}/a.jpg")
+    codes = []
+    ts = [threading.Thread(target=lambda: codes.append(srv.app.test_client().get(f'/img/{h}').status_code))
+          for _ in range(5)]
+    for t in ts:
+        t.start()
+    for t in ts:
+        t.join()
+    assert codes == [200] * 5
+    assert len(Origin.hits) == 1
+    assert srv.app.test_client().get(f'/img/{h}').data == BODY
+    assert len(Origin.hits) == 1
+
+
+def test_stale_entry_revalidates_with_etag(srv, origin):
+    h = publish(srv, f"{origin}/b.jpg")
+    c = srv.app.test_client()
+    assert c.get(f'/img/{h}').status_code == 200
+    srv.IMG_REVALIDATE_S = 0
+    r = c.get(f'/img/{h}')
+    assert r.status_code == 200 and r.data == BODY and r.mimetype == 'image/jpeg'
+    assert Origin.hits[-1] == ('/b.jpg', ETAG)
+
+
+def test_lru_eviction_keeps_newest(srv, origin):
+    c = srv.app.test_client()
+    old = publish(srv, f"{origin}/old.jpg")
+    assert c.get(f'/img/{old}').status_code == 200
+    past = time.time() - 3600
+    os.utime(srv._img_path(old, '.bin'), (past, past))
+    srv.img_cache_evict()
+    # Лимит меньше двух картинок: при следующей загрузке вытесняется самая давняя
+    srv.IMG_CACHE_MAX_MB = (srv.IMG_CACHE_BYTES + len(BODY) // 2) / (1024 * 1024)
+    new = publish(srv, f"{origin}/new.jpg")
+    assert c.get(f'/img/{new}').status_code == 200
+    assert not srv.img_cached(old)
+    assert srv.img_cached(new)
+
+
+def test_unknown_hash_is_404(srv):
+    assert srv.app.test_client().get('/img/' + '0' * 40).status_code == 404